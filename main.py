@@ -1,22 +1,35 @@
 import argparse
-import glob
+import asyncio
 import mimetypes
 import os
 import time
 from enum import Enum
-from threading import Timer
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Timer, current_thread, local
+from typing import Dict, List, Optional, Tuple
 
+import httplib2
 from tqdm import tqdm
 from google.auth.transport.requests import Request
-from google.auth.exceptions import RefreshError
+from google.auth.exceptions import RefreshError, TransportError
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import HttpRequest, MediaFileUpload, MediaIoBaseDownload
-from watchdog.events import FileSystemEvent, PatternMatchingEventHandler
+from googleapiclient.errors import HttpError
+from googleapiclient.http import (
+    BatchHttpRequest,
+    HttpRequest,
+    MediaFileUpload,
+    MediaIoBaseDownload,
+    build_http,
+)
+from watchdog.events import FileSystemEvent, RegexMatchingEventHandler
 from watchdog.observers import Observer
 
+# If modifying these scopes, delete the file token.json.
+_SCOPES = ("https://www.googleapis.com/auth/drive",)
+
 
 class Drive:
     class GoogleWorkspaceMimetypes(Enum):
@@ -26,20 +39,56 @@ class Drive:
         SLIDES = "application/vnd.google-apps.presentation"
         SHEETS = "application/vnd.google-apps.spreadsheet"
 
-    # If modifying these scopes, delete the file token.json.
-    SCOPES = list(
-        map(
-            lambda x: "https://www.googleapis.com" + x,
-            [
-                "/auth/drive",
-            ],
-        )
-    )
+    # Google Workspace mimetype each supported extension is converted to
+    _EXT_TO_MIME = {
+        ".doc": GoogleWorkspaceMimetypes.DOCS.value,
+        ".docx": GoogleWorkspaceMimetypes.DOCS.value,
+        ".ppt": GoogleWorkspaceMimetypes.SLIDES.value,
+        ".pptx": GoogleWorkspaceMimetypes.SLIDES.value,
+    }
+
+    # Mimetype of each supported extension, avoids initialising mimetypes
+    _UPLOAD_MIME = {
+        ".doc": "application/msword",
+        ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        ".ppt": "application/vnd.ms-powerpoint",
+        ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    }
+
+    SCOPES = _SCOPES
     _BASE_FOLDER_NAME = "GDrive Conversions"
-
-    def __init__(self):
+    # Maximum number of calls allowed in a single batch request
+    _BATCH_LIMIT = 100
+    # Retries with exponential backoff on 429 and 5xx responses
+    _NUM_RETRIES = 5
+    _CHUNK_SIZE = 8 * 1024 * 1024
+    # Files larger than this are uploaded in chunks with a resumable upload
+    _RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+    _REFRESH_ATTEMPTS = 3
+
+    def __init__(
+        self,
+        http: Optional[httplib2.Http] = None,
+        base_folder_id: Optional[str] = None,
+    ):
+        """
+        http can be shared across successive Drive instances to reuse its open
+        connections. It is left open by close() and must be closed by its owner.
+        base_folder_id skips looking up the base folder when it is already known.
+        """
         self._creds = self.__get_creds()
-        self._drive = build("drive", "v3", credentials=self._creds)
+        self._owns_http = http is None
+        if http is None:
+            http = build_http()
+        # Use the discovery document bundled with googleapiclient instead of
+        # fetching it on every Drive instantiation
+        self._drive = build(
+            "drive",
+            "v3",
+            http=AuthorizedHttp(self._creds, http=http),
+            static_discovery=True,
+        )
+        self._base_folder_id = base_folder_id
 
     def __get_creds(self):
         creds = None
@@ -53,11 +102,8 @@ class Drive:
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
-                # cause creds.refresh doesn't work for some reason.
-                # faster to just delete the token and request another
-                try:
-                    creds.refresh(Request())
-                except RefreshError:
+                if not self.__refresh_creds(creds):
+                    # Refresh token has been revoked or has expired
                     os.remove(token_path)
                     return self.__get_creds()
             else:
@@ -70,8 +116,28 @@ class Drive:
                 token.write(creds.to_json())
         return creds
 
+    def __refresh_creds(self, creds: Credentials):
+        """
+        Refreshes the credentials in place, retrying transient failures with
+        exponential backoff. Returns False if the refresh token is no longer valid.
+        """
+        for attempt in range(Drive._REFRESH_ATTEMPTS):
+            try:
+                creds.refresh(Request())
+                return True
+            except RefreshError as e:
+                if e.args and "invalid_grant" in str(e.args[0]):
+                    return False
+                if attempt == Drive._REFRESH_ATTEMPTS - 1:
+                    raise
+            except TransportError:
+                if attempt == Drive._REFRESH_ATTEMPTS - 1:
+                    raise
+            time.sleep(2 ** attempt)
+
     def close(self):
-        self._drive.close()
+        if self._owns_http:
+            self._drive.close()
 
     def get_recent_files(self, num: int, fields: Tuple[str, ...] = ("id", "name")):
         """
@@ -81,14 +147,22 @@ class Drive:
         results: dict = (
             self._drive.files()
             .list(pageSize=num, fields=f"nextPageToken, files({fields_string})")
-            .execute()
+            .execute(num_retries=Drive._NUM_RETRIES)
         )
         files = results.get("files", [])
         return files
 
-    def __search_file(self, query: str, fields: Tuple[str, ...] = ("id", "name")):
+    def __search_file(
+        self,
+        query: str,
+        fields: Tuple[str, ...] = ("id", "name"),
+        page_size: int = 1000,
+        limit: Optional[int] = None,
+    ):
         """
         fields options https://developers.google.com/drive/api/v3/reference/files
+        page_size 1000 is the maximum allowed by the API.
+        limit stops paginating once at least that many files are found.
         """
         fields_string = ", ".join(fields)
         page_token = None
@@ -101,20 +175,32 @@ class Drive:
                     spaces="drive",
                     fields=f"nextPageToken, files({fields_string})",
                     pageToken=page_token,
+                    pageSize=page_size,
                 )
-                .execute()
+                .execute(num_retries=Drive._NUM_RETRIES)
             )
             for found_file in response.get("files", []):
                 # Process change
                 files.append(found_file)
             page_token = response.get("nextPageToken", None)
-            if page_token is None:
+            if page_token is None or (limit is not None and len(files) >= limit):
                 break
         return files
 
+    @property
+    def base_folder_id(self) -> str:
+        return self.__get_base_folder()
+
     def __get_base_folder(self):
+        if self._base_folder_id is not None:
+            return self._base_folder_id
+        self._base_folder_id = self.__find_base_folder()
+        return self._base_folder_id
+
+    def __find_base_folder(self):
         query = f"name = '{Drive._BASE_FOLDER_NAME}' and mimeType = '{Drive.GoogleWorkspaceMimetypes.FOLDER.value}'"
-        result = self.__search_file(query)
+        # Only the first match is needed
+        result = self.__search_file(query, fields=("id",), page_size=1, limit=1)
         if result:
             folder: dict = result[0]
             return folder.get("id")
@@ -124,7 +210,9 @@ class Drive:
                 "mimeType": Drive.GoogleWorkspaceMimetypes.FOLDER.value,
             }
             folder: dict = (
-                self._drive.files().create(body=file_metadata, fields="id").execute()
+                self._drive.files()
+                .create(body=file_metadata, fields="id")
+                .execute(num_retries=Drive._NUM_RETRIES)
             )
             return folder.get("id")
 
@@ -134,53 +222,128 @@ class Drive:
         file_metadata = {"name": filename, "parents": [folder_id]}
         if mimetype is not None:
             file_metadata["mimeType"] = mimetype
-        base_mimetype = mimetypes.guess_type(filepath)[0]
-        media = MediaFileUpload(filepath, mimetype=base_mimetype)
-        uploaded_file: dict = (
-            self._drive.files()
-            .create(body=file_metadata, media_body=media, fields="id")
-            .execute()
+        ext = os.path.splitext(filename)[1].lower()
+        base_mimetype = Drive._UPLOAD_MIME.get(ext) or mimetypes.guess_type(filepath)[0]
+        resumable = os.path.getsize(filepath) > Drive._RESUMABLE_THRESHOLD
+        media = MediaFileUpload(
+            filepath,
+            mimetype=base_mimetype,
+            chunksize=Drive._CHUNK_SIZE,
+            resumable=resumable,
         )
+        request: HttpRequest = self._drive.files().create(
+            body=file_metadata, media_body=media, fields="id"
+        )
+        if not resumable:
+            uploaded_file: dict = request.execute(num_retries=Drive._NUM_RETRIES)
+            return uploaded_file.get("id")
+        uploaded_file = None
+        with tqdm(total=1.0, leave=False) as pbar:
+            while uploaded_file is None:
+                status, uploaded_file = request.next_chunk(
+                    num_retries=Drive._NUM_RETRIES
+                )
+                if status:
+                    pbar.update(status.progress() - pbar.n)
+            pbar.update(1.0 - pbar.n)
         return uploaded_file.get("id")
 
     def delete_file(self, file_id: str):
-        self._drive.files().delete(fileId=file_id).execute()
+        self._drive.files().delete(fileId=file_id).execute(
+            num_retries=Drive._NUM_RETRIES
+        )
 
-    def convert_file(self, filepath: str, delete: bool = True):
-        basename, ext = os.path.splitext(filepath)
-        mimetype = None
-        mimetype_conversion = {
-            (".doc", ".docx"): Drive.GoogleWorkspaceMimetypes.DOCS.value,
-            (".ppt", ".pptx"): Drive.GoogleWorkspaceMimetypes.SLIDES.value,
-        }
-        for k, v in mimetype_conversion.items():
-            if ext in k:
-                mimetype = v
-                break
-        uploaded_file_id = self.upload_file(filepath, mimetype)
+    def delete_files(self, file_ids: List[str]) -> List[str]:
+        """
+        Deletes the files using batch requests of up to _BATCH_LIMIT calls each.
+        Calls that fail within a batch, or whole batches that fail, are retried
+        one by one with backoff. Returns the ids of the files that could not be
+        deleted instead of raising.
+        """
+        failed_ids = []
+
+        def callback(request_id: str, _, exception: Optional[HttpError]):
+            # 404 means the file is already gone
+            if exception is not None and exception.resp.status != 404:
+                failed_ids.append(request_id)
+
+        for i in range(0, len(file_ids), Drive._BATCH_LIMIT):
+            chunk = file_ids[i : i + Drive._BATCH_LIMIT]
+            batch: BatchHttpRequest = self._drive.new_batch_http_request(
+                callback=callback
+            )
+            for file_id in chunk:
+                batch.add(
+                    self._drive.files().delete(fileId=file_id), request_id=file_id
+                )
+            try:
+                batch.execute()
+            except (HttpError, httplib2.HttpLib2Error, OSError):
+                # Batch requests are not retried by googleapiclient
+                failed_ids.extend(
+                    file_id for file_id in chunk if file_id not in failed_ids
+                )
 
+        undeleted_ids = []
+        for file_id in failed_ids:
+            try:
+                self.delete_file(file_id)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    undeleted_ids.append(file_id)
+            except (httplib2.HttpLib2Error, OSError):
+                undeleted_ids.append(file_id)
+        return undeleted_ids
+
+    def upload_for_conversion(self, filepath: str):
+        _, ext = os.path.splitext(filepath)
+        mimetype = Drive._EXT_TO_MIME.get(ext.lower())
+        return self.upload_file(filepath, mimetype)
+
+    def download_pdf(self, file_id: str, filepath: str):
         request: HttpRequest = self._drive.files().export_media(
-            fileId=uploaded_file_id, mimeType="application/pdf"
+            fileId=file_id, mimeType="application/pdf"
         )
-        with open(f"{basename}.pdf", "wb") as f:
+        with open(filepath, "wb") as f:
             with tqdm(total=1.0, leave=False) as pbar:
-                downloader = MediaIoBaseDownload(f, request)
+                downloader = MediaIoBaseDownload(
+                    f, request, chunksize=Drive._CHUNK_SIZE
+                )
                 done = False
                 while done is False:
-                    status, done = downloader.next_chunk()
-                    pbar.update(status.progress())
+                    status, done = downloader.next_chunk(num_retries=Drive._NUM_RETRIES)
+                    # progress() is cumulative while update() takes an increment
+                    pbar.update(status.progress() - pbar.n)
 
+    def convert_file(self, filepath: str, delete: bool = True):
+        basename, _ = os.path.splitext(filepath)
+        uploaded_file_id = self.upload_for_conversion(filepath)
+        self.download_pdf(uploaded_file_id, f"{basename}.pdf")
         if delete:
             self.delete_file(uploaded_file_id)
+        return uploaded_file_id
 
 
-class GDriveEventHandler(PatternMatchingEventHandler):
+class GDriveEventHandler(RegexMatchingEventHandler):
     TIMER_INTERVAL = 60
+    # Seconds without events on a file before it is converted
+    DEBOUNCE_INTERVAL = 2.0
+    SIZE_CHECK_INTERVAL = 0.5
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.__drive = None
         self.__drive_timer = None
+        # Kept across Drive instances so connections outlive the idle timer
+        self.__http = build_http()
+        # Kept across Drive instances so the folder is only looked up once
+        self.__base_folder_id = None
+        self.__pending: Dict[str, Timer] = {}
+        self.__pending_lock = Lock()
+        # Drive is not thread-safe and conversions run on the debounce timers
+        self.__convert_lock = Lock()
+        # Stops conversions whose timers have already fired
+        self.__shutdown_event = Event()
 
     def __close_drive(self):
         if self.__drive:
@@ -207,19 +370,72 @@ class GDriveEventHandler(PatternMatchingEventHandler):
     def drive(self):
         self.__restart_drive_timer()
         if not self.__drive:
-            self.__drive = Drive()
+            self.__drive = Drive(http=self.__http, base_folder_id=self.__base_folder_id)
+            self.__base_folder_id = self.__drive.base_folder_id
         return self.__drive
 
+    def __schedule_conversion(self, filepath: str):
+        with self.__pending_lock:
+            if self.__shutdown_event.is_set():
+                return
+            timer = self.__pending.get(filepath)
+            if timer is not None:
+                timer.cancel()
+            timer = Timer(
+                GDriveEventHandler.DEBOUNCE_INTERVAL, self.__convert, [filepath]
+            )
+            self.__pending[filepath] = timer
+            timer.start()
+
+    def __convert(self, filepath: str):
+        with self.__pending_lock:
+            # A later event may have rescheduled the conversion
+            if self.__pending.get(filepath) is not current_thread():
+                return
+            del self.__pending[filepath]
+        try:
+            # Wait for the file to stop growing in case it is still being written
+            size = os.path.getsize(filepath)
+            time.sleep(GDriveEventHandler.SIZE_CHECK_INTERVAL)
+            if os.path.getsize(filepath) != size:
+                self.__schedule_conversion(filepath)
+                return
+        except OSError:
+            # File was removed or renamed before it could be converted
+            return
+        with self.__convert_lock:
+            if self.__shutdown_event.is_set():
+                return
+            self.drive.convert_file(filepath)
+
     def on_created(self, event: FileSystemEvent):
-        print(event.src_path)
-        self.drive.convert_file(event.src_path)
+        # Avoid breaking the progress bars of ongoing conversions
+        tqdm.write(event.src_path)
+        self.__schedule_conversion(event.src_path)
+
+    def on_modified(self, event: FileSystemEvent):
+        with self.__pending_lock:
+            pending = event.src_path in self.__pending
+        if pending:
+            self.__schedule_conversion(event.src_path)
 
     def shutdown(self):
-        self.__stop_timer()
-        self.__close_drive()
+        with self.__pending_lock:
+            self.__shutdown_event.set()
+            for timer in self.__pending.values():
+                timer.cancel()
+            self.__pending.clear()
+        # Wait for an ongoing conversion so the drive is not closed under it
+        with self.__convert_lock:
+            self.__stop_timer()
+            self.__close_drive()
+            self.__http.close()
 
 
 class Watcher:
+    # Ctrl-C cannot interrupt a join without a timeout on Windows
+    JOIN_TIMEOUT = 1 if os.name == "nt" else None
+
     def __init__(self, event_handler, path=".") -> None:
         self._event_handler = event_handler
         self.observer = Observer()
@@ -230,47 +446,174 @@ class Watcher:
     def start(self):
         self.observer.start()
         try:
-            while True:
-                time.sleep(1)
+            # Blocks until the observer stops, only waking up periodically on
+            # Windows
+            while self.observer.is_alive():
+                self.observer.join(Watcher.JOIN_TIMEOUT)
         except KeyboardInterrupt:
+            pass
+        finally:
+            # Also runs if the observer exits by itself, as the handler's timers
+            # would otherwise keep the process alive
             self._event_handler.shutdown()
             self.observer.stop()
-        self.observer.join()
+            self.observer.join()
 
 
 def watch_dir(dir_path):
-    event_handler = GDriveEventHandler(patterns=["*.doc", "*.docx", "*.ppt", "*.pptx"])
+    # Office and LibreOffice lock files share the extension of the document
+    event_handler = GDriveEventHandler(
+        regexes=[r".*\.(docx?|pptx?)$"],
+        ignore_regexes=[r".*[/\\](~\$|\.~lock\.)[^/\\]*$"],
+    )
     watcher = Watcher(event_handler, path=dir_path)
     watcher.start()
 
 
-def convert_files(files):
-    FILE_TYPES = (".doc", ".docx", ".ppt", ".pptx")
-    drive = Drive()
+async def convert_files_concurrently(
+    drive: Drive, filepaths: List[str], max_parallel: int
+):
+    """
+    Converts the files as a pipeline of upload and download stages sharing
+    max_parallel worker threads, so uploads of later files overlap with
+    downloads of earlier ones. Each worker thread gets its own Drive as the
+    underlying http client is not thread-safe. A failed conversion is reported
+    without stopping the others. Intermediate files are deleted with drive in
+    batches as conversions finish, and any left over are deleted at the end.
+    """
+    thread_data = local()
+    drives: List[Drive] = []
+    # Resolved once so the workers neither look it up nor each create the folder
+    base_folder_id = drive.base_folder_id
+    # Ids are recorded by the upload threads so that uploads finishing after
+    # an error are still deleted
+    uploaded_file_ids = set()
+    converted_file_ids: List[str] = []
+    aborted = Event()
+
+    def get_drive() -> Drive:
+        if not hasattr(thread_data, "drive"):
+            thread_data.drive = Drive(base_folder_id=base_folder_id)
+            drives.append(thread_data.drive)
+        return thread_data.drive
+
+    def upload(filepath: str):
+        # Uploads still queued when the executors shut down are skipped
+        if aborted.is_set():
+            return None
+        file_id = get_drive().upload_for_conversion(filepath)
+        uploaded_file_ids.add(file_id)
+        return file_id
+
+    def download(file_id: str, filepath: str):
+        basename, _ = os.path.splitext(filepath)
+        get_drive().download_pdf(file_id, f"{basename}.pdf")
+
+    def delete(file_ids: List[str]):
+        undeleted_ids = drive.delete_files(file_ids)
+        uploaded_file_ids.difference_update(file_ids)
+        if undeleted_ids:
+            tqdm.write(
+                f"Failed to delete intermediate files from Drive: "
+                f"{', '.join(undeleted_ids)}"
+            )
+
+    loop = asyncio.get_running_loop()
+
+    async def convert(filepath: str):
+        file_id = None
+        try:
+            file_id = await loop.run_in_executor(upload_executor, upload, filepath)
+            if file_id is not None:
+                await loop.run_in_executor(
+                    download_executor, download, file_id, filepath
+                )
+        except Exception as e:
+            tqdm.write(f"Failed to convert {filepath}: {e}")
+        return file_id
+
+    # Split the workers between the stages so that at most max_parallel
+    # requests are in flight. With a single worker both stages share it.
+    upload_workers = max(1, max_parallel // 2)
+    download_workers = max_parallel - upload_workers
+    upload_executor = ThreadPoolExecutor(max_workers=upload_workers)
+    download_executor = (
+        ThreadPoolExecutor(max_workers=download_workers)
+        if download_workers > 0
+        else upload_executor
+    )
+    # A single thread keeps the deletes off the event loop and serializes use
+    # of drive, whose http client is not thread-safe
+    delete_executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        tasks = [convert(i) for i in filepaths]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            file_id = await task
+            if file_id is None:
+                continue
+            converted_file_ids.append(file_id)
+            if len(converted_file_ids) == Drive._BATCH_LIMIT:
+                delete_executor.submit(delete, converted_file_ids)
+                converted_file_ids = []
+    except BaseException:
+        aborted.set()
+        raise
+    finally:
+        upload_executor.shutdown()
+        download_executor.shutdown()
+        delete_executor.shutdown()
+        # Worker threads have exited once the executors shut down
+        for worker_drive in drives:
+            worker_drive.close()
+        delete(list(uploaded_file_ids))
+
+
+def find_files(dir_path: str) -> List[str]:
+    """
+    Recursively finds files with a supported extension in a single walk of the
+    directory. Hidden files and directories are skipped, as with glob.
+    """
+    filepaths = []
+    for root, dirs, filenames in os.walk(dir_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for filename in filenames:
+            if filename.startswith("."):
+                continue
+            if os.path.splitext(filename)[1].lower() in Drive._EXT_TO_MIME:
+                filepaths.append(os.path.join(root, filename))
+    return filepaths
+
+
+def convert_files(files, max_parallel: int = 4):
+    # All files are converted together so they share the concurrency and the
+    # batched deletes
+    filepaths = []
     for f in files:
         filepath = os.path.abspath(os.path.expanduser(f))
         if os.path.isdir(filepath):
-            search_globs = list(map(lambda x: f"{filepath}/**/*{x}", FILE_TYPES))
-            filepaths = [
-                result
-                for search_glob in search_globs
-                for result in glob.glob(search_glob, recursive=True)
-            ]
-            if not len(filepaths):
-                return
+            dir_files = find_files(filepath)
+            if not len(dir_files):
+                continue
             confirm = input(
-                f"There are {len(filepaths)} files to convert, are you sure? [y/n] \n"
+                f"There are {len(dir_files)} files to convert, are you sure? [y/n] \n"
             )
             if confirm in ("y", "Y"):
-                for i in tqdm(filepaths):
-                    drive.convert_file(i)
+                filepaths.extend(dir_files)
 
         else:
-            if os.path.splitext(filepath)[1] not in FILE_TYPES:
+            if os.path.splitext(filepath)[1].lower() not in Drive._EXT_TO_MIME:
                 print(f"{filepath} has an invalid extension. Skipping file ...")
             else:
-                drive.convert_file(filepath)
-    drive.close()
+                filepaths.append(filepath)
+    # A file given both directly and through its directory is converted once
+    filepaths = list(dict.fromkeys(filepaths))
+    if not filepaths:
+        return
+    drive = Drive()
+    try:
+        asyncio.run(convert_files_concurrently(drive, filepaths, max_parallel))
+    finally:
+        drive.close()
 
 
 def create_parser():
@@ -278,6 +621,14 @@ def create_parser():
         description="Use Google Drive to convert certain filetypes to pdf."
     )
     parser.add_argument("-w", "--w", dest="watch", action="store_true")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=4,
+        help="number of concurrent requests, split between uploads and downloads",
+    )
     parser.add_argument(
         "files",
         metavar="file",
@@ -300,6 +651,6 @@ if __name__ == "__main__":
             print("Invalid args. Only accepts 1 directory to watch for new files.")
     else:
         if args.files:
-            convert_files(args.files)
+            convert_files(args.files, args.jobs)
         else:
             print("No files given.")